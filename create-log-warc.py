@@ -2,11 +2,10 @@
 from argparse import ArgumentParser
 from pathlib import Path
 from datetime import datetime, timezone
-import importlib.metadata
 import sys
 from warcio import WARCWriter
 from edgi_versionista_warc.versionista_warc import format_datetime_iso
-from edgi_versionista_warc.warctools import WARC_VERSION
+from edgi_versionista_warc.warctools import WARC_SOFTWARE, WARC_VERSION, WRITE_BUFFER_SIZE
 
 
 def cli() -> None:
@@ -31,11 +30,11 @@ def cli() -> None:
 
     warc_name = f'{log_path.stem}{warc_suffix}'
     warc_path = log_path.parent / f'{log_path.stem}{warc_suffix}'
-    with warc_path.open('wb') as warcfile:
+    with warc_path.open('wb', buffering=WRITE_BUFFER_SIZE) as warcfile:
         warc = WARCWriter(warcfile, gzip=gzip, warc_version=WARC_VERSION)
 
         warc.write_record(warc.create_warcinfo_record(warc_name, {
-            'software': f'warcio/{importlib.metadata.version("warcio")}',
+            'software': WARC_SOFTWARE,
             'format': f'WARC file version {WARC_VERSION}',
             'operator': '"Environmental Data & Governance Initiative" <contact@envirodatagov.org>',
             'description': (
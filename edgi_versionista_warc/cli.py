@@ -1,18 +1,35 @@
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 import logging
 from pathlib import Path
 from dateutil.parser import parse as parse_timestamp
-from .versionista_warc import main
-from .warctools import GIGABYTE
+from .versionista_warc import DEFAULT_CONCURRENCY, main
+from .warctools import DEFAULT_COMPRESSION_LEVEL, GIGABYTE
+
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise ArgumentTypeError(f'must be at least 1 (got {value})')
+    return number
 
 
 def cli() -> None:
     parser = ArgumentParser(description="Create WARC files to store captures of Versionista data from EDGI's Web Monitoring Database")
     parser.add_argument('--uncompressed', action='store_true', help='Create uncompressed `.warc` files instead of gzipped `.warc.gz` files')
+    parser.add_argument('--compression-level', type=int, choices=range(0, 4), default=DEFAULT_COMPRESSION_LEVEL, help=(
+        'How much to compress gzipped WARCs, from 0 (fastest) to 3 (smallest)'
+    ))
     parser.add_argument('--limit', type=int, help='Archive up to this many records from Web Monitoring DB')
     parser.add_argument('--size', type=float, default=7.95, help='Generate WARC up to about this many gigabytes each')
     parser.add_argument('--from', type=parse_timestamp, help='Start from this timestamp (ISO format)')
     parser.add_argument('--guess-status', action='store_true', help='Guess status code when it is missing from DB data')
+    parser.add_argument('--concurrency', type=positive_int, default=DEFAULT_CONCURRENCY, help=(
+        'Download up to this many response bodies at once'
+    ))
+    parser.add_argument('--body-cache', help=(
+        'Directory to cache downloaded response bodies in. Later runs with the '
+        'same cache directory will not need to download them again.'
+    ))
     parser.add_argument('--filename', default='edgi-wm-versionista', help=(
         'Base name for the generated WARC files. Each file will be named '
         '`<name>--<timestamp>.warc`'
@@ -32,10 +49,13 @@ def cli() -> None:
         path=str(path),
         name=configuration.filename,
         gzip=(not configuration.uncompressed),
+        compression_level=configuration.compression_level,
         limit=configuration.limit,
         warc_size=int(configuration.size * GIGABYTE),
         start_date=getattr(configuration, 'from'),
-        guess_status=configuration.guess_status
+        guess_status=configuration.guess_status,
+        concurrency=configuration.concurrency,
+        body_cache=configuration.body_cache
     )
 
 
@@ -1,29 +1,52 @@
-from collections import Counter
+import atexit
+from collections import Counter, deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 import email.utils
+from functools import cache, partial
 import hashlib
-from io import BytesIO
 from itertools import islice
 import logging
+import os
+from pathlib import Path
+from queue import Queue
 import re
+from tempfile import NamedTemporaryFile
 from textwrap import dedent
+from threading import Thread
 import httpx
 from tqdm import tqdm
 from warcio import StatusAndHeaders
 from warcio.recordloader import ArcWarcRecord
+from warcio.utils import Digester
 from .web_monitoring_db import Client as DbClient
-from .warctools import GIGABYTE, STANDARD_STATUS_MESSAGES, WarcSeries, status_text, create_metadata_record
+from .warctools import (
+    DEFAULT_COMPRESSION_LEVEL,
+    GIGABYTE,
+    STANDARD_STATUS_MESSAGES,
+    BytesView,
+    WarcSeries,
+    status_text,
+    create_metadata_record
+)
 
 
 logger = logging.getLogger(__name__)
 
 # Headers known to have been generated by Versionista, and not sourced from the
 # original captured request.
-BAD_HEADERS = set([
+BAD_HEADERS = frozenset([
     'age', 'date', 'vary', 'expires', 'x-cachee', 'connection', 'accept-ranges', 'cache-control', 'transfer-encoding'
 ])
 
-URL_LIKE = re.compile(r'^(https?|ftp)://')
+URL_PREFIXES = ('http://', 'https://', 'ftp://')
+
+# Status line for the synthesized responses for each redirect in a history.
+REDIRECT_STATUS = status_text(302)
+
+# How many response bodies to download at the same time.
+DEFAULT_CONCURRENCY = 32
 
 
 class BadDataError(Exception):
@@ -58,16 +81,119 @@ def format_datetime_iso(time):
     return iso_time
 
 
-body_loader = httpx.Client(transport=httpx.HTTPTransport(retries=3))
-
-
-def load_response_body(version):
-    body_response = body_loader.get(version['body_url'], params={'different': False}, follow_redirects=True)
-    if body_response.status_code == 404:
-        raise MissingBodyError(version['uuid'])
-
-    body_response.raise_for_status()
-    actual_hash = hashlib.sha256(body_response.content).hexdigest()
+def create_body_loader(concurrency: int = DEFAULT_CONCURRENCY) -> httpx.Client:
+    """
+    Create an HTTP client for downloading response bodies from up to
+    ``concurrency`` threads at once.
+    """
+    # Allow a connection for every prefetch worker, plus one for bodies that
+    # get loaded synchronously, so no request ever waits on the pool. Keep all
+    # of them alive between requests so they can be reused rather than paying
+    # for a new TCP + TLS handshake on most requests. (Note limits have to be
+    # set on the transport; `Client` ignores them otherwise.)
+    connections = concurrency + 1
+    return httpx.Client(transport=httpx.HTTPTransport(
+        retries=3,
+        limits=httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+    ))
+
+
+@cache
+def default_body_loader() -> httpx.Client:
+    """
+    Get a shared client for downloading response bodies when no other client
+    is given. It is created on first use and closed at exit.
+    """
+    client = create_body_loader()
+    atexit.register(client.close)
+    return client
+
+
+def load_response_body(
+    version,
+    client: httpx.Client | None = None,
+    body_cache: Path | None = None
+) -> tuple[bytearray, str]:
+    """
+    Load and verify the body of a version. Returns the body and its WARC payload
+    digest. Downloads use ``client`` if set (otherwise they use
+    ``default_body_loader()``).
+
+    If ``body_cache`` is set, bodies are read from and saved to files in that
+    directory (named by their SHA-256 hash), so they only need to be downloaded
+    once across multiple runs.
+    """
+    # The cache is an optimization; failing to read or save it is not an error.
+    cache_file = body_cache / version['body_hash'] if body_cache and version['body_hash'] else None
+    cached_body = None
+    if cache_file and cache_file.exists():
+        try:
+            with cache_file.open('rb') as file:
+                cached_body = bytearray(os.fstat(file.fileno()).st_size)
+                file.readinto(cached_body)
+        except OSError as error:
+            cached_body = None
+            logger.warning(f'Could not read cached body; downloading again (version={version['uuid']}): {error}')
+
+    if cached_body is not None:
+        if hashlib.sha256(cached_body).hexdigest() == version['body_hash']:
+            payload_digester = Digester('sha1')
+            payload_digester.update(cached_body)
+            return cached_body, str(payload_digester)
+        else:
+            logger.warning(f'Cached body does not match expected hash; downloading again (version={version['uuid']})')
+
+    body, payload_digest = download_response_body(version, client)
+    if cache_file:
+        try:
+            write_file_atomically(cache_file, body)
+        except OSError as error:
+            logger.warning(f'Could not cache body (version={version['uuid']}): {error}')
+
+    return body, payload_digest
+
+
+def write_file_atomically(path: Path, data) -> None:
+    """
+    Write ``data`` to a temporary file and then move it to ``path``, so nothing
+    reading ``path`` ever sees a partially written file.
+    """
+    with NamedTemporaryFile(dir=path.parent, delete=False) as file:
+        try:
+            file.write(data)
+            file.close()
+            os.replace(file.name, path)
+        except BaseException:
+            Path(file.name).unlink(missing_ok=True)
+            raise
+
+
+def download_response_body(version, client: httpx.Client | None = None) -> tuple[bytearray, str]:
+    """
+    Download and verify the body of a version. Returns the body and its WARC
+    payload digest.
+    """
+    if client is None:
+        client = default_body_loader()
+
+    # Hash the body as it streams in rather than making a second pass over it
+    # once it has all been read. While we're at it, calculate the payload
+    # digest warcio would otherwise have to calculate later on the thread that
+    # is writing the WARC.
+    hasher = hashlib.sha256()
+    payload_digester = Digester('sha1')
+    body = bytearray()
+    with client.stream('GET', version['body_url'], params={'different': False}, follow_redirects=True) as body_response:
+        if body_response.status_code == 404:
+            raise MissingBodyError(version['uuid'])
+
+        body_response.raise_for_status()
+        for chunk in body_response.iter_bytes(64 * 1024):
+            hasher.update(chunk)
+            payload_digester.update(chunk)
+            body.extend(chunk)
+
+    actual_hash = hasher.hexdigest()
     if actual_hash != version['body_hash']:
         detail = f'  Expected: {version["body_hash"]}\n  Actual:   {actual_hash}'
         raise BadDataError(
@@ -76,7 +202,87 @@ def load_response_body(version):
             reason='Mismatched_body_data'
         )
 
-    return body_response.content
+    return body, str(payload_digester)
+
+
+def read_ahead(items: Iterable, size: int) -> Iterator:
+    """
+    Iterate through ``items`` on a background thread, keeping up to ``size``
+    of them ready to go. This keeps slow sources (like paginated API results)
+    loading while the caller is busy working on earlier items.
+    """
+    buffer = Queue(maxsize=size)
+    end = object()
+    error = None
+
+    def produce():
+        nonlocal error
+        try:
+            for item in items:
+                buffer.put(item)
+        except Exception as producer_error:
+            error = producer_error
+        finally:
+            buffer.put(end)
+
+    Thread(target=produce, daemon=True).start()
+    while (item := buffer.get()) is not end:
+        yield item
+
+    if error:
+        raise error
+
+
+def prefetch_bodies(
+    warc: WarcSeries,
+    versions: Iterable[dict],
+    concurrency: int = DEFAULT_CONCURRENCY,
+    body_cache: Path | None = None,
+    guess_status: bool = False
+) -> Iterator[tuple[dict, Callable[[], tuple[bytearray, str]]]]:
+    """
+    Download response bodies for upcoming versions in the background so we
+    aren't waiting on the network for each version in turn. Yields each version
+    (in the same order they came in) along with a function that returns its
+    body, blocking until the download is complete if necessary.
+
+    Bodies that are likely to be written as revisits are not prefetched (they
+    will be loaded synchronously if they turn out to be needed after all).
+    Neither are bodies for versions that ``create_version_records()`` will
+    reject before it needs their body (see ``check_version()``).
+
+    See ``load_response_body()`` for details on ``body_cache``.
+    """
+    window = deque()
+    fetching = set()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    client = create_body_loader(concurrency)
+    try:
+        for version in versions:
+            body_hash = version['body_hash']
+            try:
+                check_version(version, guess_status=guess_status)
+                skip_prefetch = body_hash in fetching or bool(warc.get_revisit(body_hash))
+            except BadDataError:
+                skip_prefetch = True
+
+            if skip_prefetch:
+                window.append((version, partial(load_response_body, version, client, body_cache=body_cache), None))
+            else:
+                fetching.add(body_hash)
+                window.append((version, executor.submit(load_response_body, version, client, body_cache=body_cache).result, body_hash))
+
+            if len(window) >= concurrency:
+                version, load_body, body_hash = window.popleft()
+                fetching.discard(body_hash)
+                yield version, load_body
+
+        while window:
+            version, load_body, _ = window.popleft()
+            yield version, load_body
+    finally:
+        executor.shutdown(cancel_futures=True)
+        client.close()
 
 
 def version_history(version: dict) -> list[str]:
@@ -86,7 +292,7 @@ def version_history(version: dict) -> list[str]:
             for redirect in version['source_metadata']['redirects']:
                 if not isinstance(redirect, str) or len(redirect) == 0:
                     logger.warning(f'Version {version['uuid']} has null redirect')
-                elif not URL_LIKE.match(redirect):
+                elif not redirect.startswith(URL_PREFIXES):
                     logger.warning(f'Version {version['uuid']} has non-URL redirect: "{redirect}"')
                 else:
                     history.append(redirect)
@@ -146,13 +352,40 @@ def guess_version_status(version: dict) -> int:
     return 200
 
 
-def create_version_records(warc: WarcSeries, version: dict, guess_status=False) -> list[ArcWarcRecord]:
+def might_be_html(version: dict) -> bool:
+    media = version['media_type']
+    return not media or bool(re.search(r'[/+]x?html', media))
+
+
+def check_version(version: dict, guess_status=False) -> None:
+    """
+    Raise a ``BadDataError`` if a version can't be archived for reasons that
+    are known without loading its body.
+    """
+    if version['body_url'] is None:
+        raise MissingBodyError(version['uuid'])
+
+    is_ftp = version_history(version)[-1].lower().startswith('ftp://')
+    if version['status'] is None and not is_ftp and might_be_html(version) and not guess_status:
+        raise MissingStatusCode(version['uuid'])
+
+
+def create_version_records(
+    warc: WarcSeries,
+    version: dict,
+    guess_status=False,
+    load_body: Callable[[], tuple[bytearray, str]] | None = None
+) -> list[ArcWarcRecord]:
     records = []
     version_id = version['uuid']
+    # Several records can need the body (e.g. multiple FTP URLs in the history),
+    # but it should only ever be downloaded and verified once.
+    load_body = cache(load_body or partial(load_response_body, version))
     capture_time = version["capture_time"]
+    warc_date = format_datetime_iso(capture_time)
+    http_date = format_datetime_http(capture_time)
 
-    if version['body_url'] is None:
-        raise MissingBodyError(version_id)
+    check_version(version, guess_status=guess_status)
 
     history = version_history(version)
     final_url = history[-1]
@@ -164,57 +397,61 @@ def create_version_records(warc: WarcSeries, version: dict, guess_status=False)
         # Versionista used to not give us status codes for non-HTML responses;
         # we are reasonably confident that if we got a non-HTML response, it was
         # not an error response.
-        media = version['media_type']
-        if media and not re.search(r'[/+]x?html', media):
+        if not might_be_html(version):
             version['status'] = 200
-        elif guess_status:
+        else:
+            # check_version() has already rejected this if guessing is off.
             version['status'] = guess_version_status(version)
             logger.warning(f'Guessed status (version={version_id}, status={version['status']})')
-        else:
-            raise MissingStatusCode(version_id)
 
+    builder = warc.builder
+    database_url = f'https://api.monitoring.envirodatagov.org/api/v0/versions/{version_id}'
+    source_url = version['source_metadata']['url']
     first_record_id = None
+    record_id_prefix = f'<{database_url}/responses/'
     previous_url = None
-    for index, url in enumerate(history):
-        database_url = f'https://api.monitoring.envirodatagov.org/api/v0/versions/{version_id}'
-        record_id = f'<{database_url}/responses/{index}>'
+    for index, (url, next_url) in enumerate(zip(history, history[1:] + [None], strict=True)):
+        record_id = f'{record_id_prefix}{index}>'
         warc_header = {
             'WARC-Record-ID': record_id,
-            'WARC-Date': format_datetime_iso(capture_time),
+            'WARC-Date': warc_date,
             # This field is non-standard, and comes from warcit:
             #   https://github.com/webrecorder/warcit#warc-structure-and-format
             # We put the Versionista URL here and the WM database URL in the
             # metadata record.
-            'WARC-Source-URI': version['source_metadata']['url'],
+            'WARC-Source-URI': source_url,
         }
         if index == 0:
             first_record_id = record_id
         else:
             warc_header['WARC-Concurrent-To'] = first_record_id
 
-        recorded_headers = { 'Date': format_datetime_http(capture_time) }
         if url.lower().startswith('ftp://'):
-            records.append(warc.builder.create_warc_record(
+            body, warc_header['WARC-Payload-Digest'] = load_body()
+            records.append(builder.create_warc_record(
                 url,
                 'resource',
                 warc_headers_dict=warc_header,
                 warc_content_type=(version['media_type'] or 'application/octet-stream'),
-                payload=BytesIO(load_response_body(version))
+                payload=BytesView(body),
+                length=len(body)
             ))
-        elif url == final_url:
-            if version['media_type']:
-                recorded_headers['Content-Type'] = version['media_type']
-            if version['headers']:
-                for key, value in version['headers'].items():
-                    if key.lower() not in BAD_HEADERS:
-                        recorded_headers[key] = value
-            http_headers = StatusAndHeaders(status_text(version['status']), recorded_headers.items(), protocol='HTTP/1.1')
+        elif next_url is None:
+            recorded_headers = [('Date', http_date)]
+            original_headers = version['headers'] or {}
+            # A Content-Type in the original headers takes precedence.
+            if version['media_type'] and 'Content-Type' not in original_headers:
+                recorded_headers.append(('Content-Type', version['media_type']))
+            recorded_headers.extend(
+                (key, value) for key, value in original_headers.items() if key.lower() not in BAD_HEADERS
+            )
+            http_headers = StatusAndHeaders(status_text(version['status']), recorded_headers, protocol='HTTP/1.1')
 
             revisit = warc.get_revisit(version['body_hash'])
             if revisit:
                 # For some reason this is not an option on create_revisit_record.
                 warc_header['WARC-Refers-To'] = revisit['id']
-                records.append(warc.builder.create_revisit_record(
+                records.append(builder.create_revisit_record(
                     url,
                     revisit['warc_digest'],
                     revisit['uri'],
@@ -223,19 +460,21 @@ def create_version_records(warc: WarcSeries, version: dict, guess_status=False)
                     warc_headers_dict=warc_header
                 ))
             else:
-                record = warc.builder.create_warc_record(
+                body, warc_header['WARC-Payload-Digest'] = load_body()
+                record = builder.create_warc_record(
                     url,
                     'response',
-                    payload=BytesIO(load_response_body(version)),
+                    payload=BytesView(body),
+                    length=len(body),
                     http_headers=http_headers,
                     warc_headers_dict=warc_header
                 )
                 records.append(record)
                 warc.cache_revisitable_record(record, version['body_hash'])
         else:
-            recorded_headers['Location'] = history[index + 1]
-            http_headers = StatusAndHeaders(status_text(302), recorded_headers.items(), protocol='HTTP/1.1')
-            records.append(warc.builder.create_warc_record(
+            recorded_headers = [('Date', http_date), ('Location', next_url)]
+            http_headers = StatusAndHeaders(REDIRECT_STATUS, recorded_headers, protocol='HTTP/1.1')
+            records.append(builder.create_warc_record(
                 url,
                 'response',
                 payload=None,
@@ -247,10 +486,10 @@ def create_version_records(warc: WarcSeries, version: dict, guess_status=False)
             first_record_id = record_id
 
         records.append(create_metadata_record(
-            warc.builder,
+            builder,
             url,
             header={
-                'WARC-Date': format_datetime_iso(capture_time),
+                'WARC-Date': warc_date,
                 'WARC-Refers-To': record_id,
                 'WARC-Concurrent-To': first_record_id,
             },
@@ -280,6 +519,9 @@ def main(
     warc_size=int(7.95 * GIGABYTE),
     start_date: datetime | None = None,
     guess_status: bool = False,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    compression_level: int = DEFAULT_COMPRESSION_LEVEL,
+    body_cache: str | None = None,
 ):
     limit = limit or 0
 
@@ -290,19 +532,31 @@ def main(
         expected_records = min(expected_records, limit)
         chunk_size = min(chunk_size, limit)
 
+    if body_cache:
+        body_cache = Path(body_cache)
+        body_cache.mkdir(parents=True, exist_ok=True)
+
     db_client = DbClient.from_env()
 
     skipped = Counter()
 
-    warc_builder = WarcSeries(path, name=name, gzip=gzip, size=warc_size, revisit_cache_size=100_000, info={
-        'operator': '"Environmental Data & Governance Initiative" <contact@envirodatagov.org>',
-        'description': dedent("""\
-            Web content captured by EDGI's Web Monitoring project using
-            Versionista (https://versionista.com). This WARC is synthesized
-            from data that was originally archived extracted from
-            Versionista via https://github.com/edgi-govdata-archiving/versionista-outputter
-            and https://github.com/edgi-govdata-archiving/web-monitoring-versionista-scraper.""").replace('\n', ' ')
-    })
+    warc_builder = WarcSeries(
+        path,
+        name=name,
+        gzip=gzip,
+        size=warc_size,
+        revisit_cache_size=100_000,
+        compression_level=compression_level,
+        info={
+            'operator': '"Environmental Data & Governance Initiative" <contact@envirodatagov.org>',
+            'description': dedent("""\
+                Web content captured by EDGI's Web Monitoring project using
+                Versionista (https://versionista.com). This WARC is synthesized
+                from data that was originally archived extracted from
+                Versionista via https://github.com/edgi-govdata-archiving/versionista-outputter
+                and https://github.com/edgi-govdata-archiving/web-monitoring-versionista-scraper.""").replace('\n', ' ')
+        }
+    )
 
     try:
         with warc_builder as warc:
@@ -310,10 +564,20 @@ def main(
             if limit:
                 versions = islice(versions, start, limit)
 
+            # Load the next page of results from the DB while working through
+            # the current one.
+            versions = read_ahead(versions, 2 * chunk_size)
+            versions = prefetch_bodies(
+                warc,
+                versions,
+                concurrency=concurrency,
+                body_cache=body_cache,
+                guess_status=guess_status
+            )
             progress_bar = tqdm(versions, unit=' versions', total=expected_records, disable=None)
-            for version in progress_bar:
+            for version, load_body in progress_bar:
                 try:
-                    warc.write_records(create_version_records(warc, version, guess_status=guess_status))
+                    warc.write_records(create_version_records(warc, version, guess_status=guess_status, load_body=load_body))
                 except BadDataError as error:
                     logger.warning(str(error))
                     skipped[error.reason] += 1
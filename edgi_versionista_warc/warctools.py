@@ -1,11 +1,16 @@
-from collections import Counter, OrderedDict
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
 from http import HTTPStatus
 import importlib.metadata
-from io import BytesIO, BufferedWriter
+from io import BytesIO, BufferedWriter, RawIOBase, SEEK_CUR, SEEK_END, SEEK_SET
 import logging
+import os
 from pathlib import Path
+import sqlite3
 from typing import Self
 from dateutil.parser import parse as parse_timestamp
+from isal import isal_zlib
 from warcio import WARCWriter
 from warcio.warcwriter import BufferWARCWriter
 from warcio.recordbuilder import RecordBuilder
@@ -17,11 +22,25 @@ logger = logging.getLogger(__name__)
 
 GIGABYTE = 1024 * 1024 * 1024
 
+# Buffer size for WARC output files. WARCs are written sequentially and can be
+# many gigabytes, so this is much bigger than Python's default (8 KiB). Being a
+# power of two, it's also a multiple of the block size on any typical disk.
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+
 WARC_VERSION = '1.1'
 
+# Compression level for gzipped WARCs. ISA-L only supports levels 0 (fastest)
+# through 3 (smallest), and even 3 is many times faster than zlib's level 9 (what
+# warcio uses).
+DEFAULT_COMPRESSION_LEVEL = isal_zlib.ISAL_BEST_COMPRESSION
+
+# Identifies the library that wrote a WARC (for warcinfo records).
+WARC_SOFTWARE = f'warcio/{importlib.metadata.version("warcio")}'
+
 STANDARD_STATUS_MESSAGES = set(f'{s.value} {s.phrase.lower()}' for s in HTTPStatus)
 
 
+@cache
 def status_text(code):
     status = HTTPStatus(code)
     return f'{status.value} {status.phrase}'
@@ -30,31 +49,184 @@ def status_text(code):
 # Based on warcio's implementation:
 # https://github.com/webrecorder/warcio/blob/6775fb9ea3505db144a145c5a8b3ba1dfb822ac1/warcio/recordbuilder.py#L46-L52
 # This is... not really up-to-spec, but generally good enough.
-def serialize_warc_fields(fields_dict: dict) -> BytesIO:
-    output = BytesIO()
-    for name, value in fields_dict.items():
-        if not value:
-            continue
-
-        line = f'{name}: {value}\r\n'
-        output.write(line.encode('utf-8'))
-
-    return output
+def serialize_warc_fields(fields_dict: dict) -> bytes:
+    return b''.join(
+        f'{name}: {value}\r\n'.encode('utf-8')
+        for name, value in fields_dict.items()
+        if value
+    )
 
 
 def create_metadata_record(writer: RecordBuilder, uri: str, header: dict, data: dict) -> ArcWarcRecord:
     payload = serialize_warc_fields(data)
-    length = payload.tell()
-    payload.seek(0)
     return writer.create_warc_record(
         uri,
         'metadata',
         warc_headers_dict=header,
-        payload=payload,
-        length=length
+        payload=BytesIO(payload),
+        length=len(payload)
     )
 
 
+class BytesView(RawIOBase):
+    """
+    A read-only, seekable file-like view of a bytes-like object. Unlike
+    ``BytesIO``, this doesn't copy the underlying data up front (even if it is
+    mutable, like a ``bytearray``), which makes it a cheaper way to give large
+    payloads to warcio.
+    """
+
+    def __init__(self, data):
+        self._view = memoryview(data).cast('B')
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size: int | None = -1) -> bytes:
+        # Slice the view directly. (RawIOBase's implementation reads into a
+        # scratch buffer and then copies that, which is much slower.)
+        end = len(self._view) if size is None or size < 0 else self._position + size
+        chunk = self._view[self._position:end].tobytes()
+        self._position += len(chunk)
+        return chunk
+
+    def readinto(self, buffer) -> int:
+        target = memoryview(buffer).cast('B')
+        chunk = self._view[self._position:self._position + len(target)]
+        target[:len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset: int, whence: int = SEEK_SET) -> int:
+        if whence == SEEK_SET:
+            position = offset
+        elif whence == SEEK_CUR:
+            position = self._position + offset
+        elif whence == SEEK_END:
+            position = len(self._view) + offset
+        else:
+            raise ValueError(f'Invalid whence ({whence})')
+
+        if position < 0:
+            raise ValueError(f'Negative seek position {position}')
+
+        self._position = position
+        return position
+
+
+class RecordWriter:
+    """
+    Wraps a binary file for use with warcio's ``WARCWriter``. warcio calls
+    ``flush()`` at the end of every record, which would defeat the point of
+    a large write buffer, so this only actually flushes the file every
+    ``flush_interval`` records.
+
+    It also keeps a running count of bytes written, so checking the size of
+    the output (via ``tell()``) never has to touch the file. (This assumes the
+    file was empty to start with.)
+
+    If writing a record fails partway through, call ``discard_record()`` to
+    remove whatever part of it was already written.
+    """
+
+    def __init__(self, file: BufferedWriter, flush_interval: int = 64):
+        self.file = file
+        self.flush_interval = flush_interval
+        self.bytes_written = 0
+        self._record_start = 0
+        self._unflushed_records = 0
+
+    def write(self, data) -> int:
+        return self._write_file(data)
+
+    def flush(self) -> None:
+        self._record_start = self.bytes_written
+        self._unflushed_records += 1
+        if self._unflushed_records >= self.flush_interval:
+            self._unflushed_records = 0
+            self.file.flush()
+
+    def tell(self) -> int:
+        return self.bytes_written
+
+    def discard_record(self) -> None:
+        self.file.seek(self._record_start)
+        self.file.truncate()
+        self.bytes_written = self._record_start
+
+    def close(self) -> None:
+        self.file.close()
+
+    def _write_file(self, data) -> int:
+        self.bytes_written += len(data)
+        return self.file.write(data)
+
+
+class GzipRecordWriter(RecordWriter):
+    """
+    A ``RecordWriter`` that compresses each WARC record written through it as
+    a separate gzip member (as is standard for ``.warc.gz`` files). This is a
+    drop-in replacement for warcio's own gzip support (use it with
+    ``WARCWriter(..., gzip=False)``), but compresses with ISA-L, which is
+    several times faster than zlib.
+
+    Because every record is an independent gzip member, records are compressed
+    in parallel on a pool of threads (ISA-L releases the GIL), pigz-style, and
+    written to the file in order as they finish. That means ``tell()`` lags
+    behind by whatever records are still being compressed.
+
+    Like warcio's internal ``GzippingWrapper``, this relies on warcio calling
+    ``flush()`` exactly once, at the end of each record.
+    """
+
+    def __init__(
+        self,
+        file: BufferedWriter,
+        level: int = DEFAULT_COMPRESSION_LEVEL,
+        threads: int | None = None,
+        **kwargs
+    ):
+        super().__init__(file, **kwargs)
+        self.level = level
+        self._record = []
+        self._threads = threads or os.cpu_count() or 1
+        self._executor = ThreadPoolExecutor(max_workers=self._threads)
+        self._compressing = deque()
+
+    def write(self, data) -> int:
+        self._record.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        if self._record:
+            record = b''.join(self._record)
+            self._record.clear()
+            self._compressing.append(self._executor.submit(isal_zlib.compress, record, self.level, 16 + isal_zlib.MAX_WBITS))
+
+        # Keep a couple records queued up for each thread.
+        while len(self._compressing) > 2 * self._threads:
+            self._write_file(self._compressing.popleft().result())
+
+        super().flush()
+
+    def discard_record(self) -> None:
+        self._record.clear()
+
+    def close(self) -> None:
+        # Anything written since the last flush() is an incomplete record.
+        self._record.clear()
+        try:
+            while self._compressing:
+                self._write_file(self._compressing.popleft().result())
+        finally:
+            self._executor.shutdown(cancel_futures=True)
+            super().close()
+
+
 class WarcSeries:
     """
     Writes a series of WARC files, starting new files when the previous ones
@@ -66,20 +238,41 @@ class WarcSeries:
     fancier.
     """
 
-    def __init__(self, path, name='archive', gzip=True, size=8 * GIGABYTE, info=None, revisit_cache_size=10_000):
-        self._file: BufferedWriter | None = None
+    def __init__(
+        self,
+        path,
+        name='archive',
+        gzip=True,
+        size=8 * GIGABYTE,
+        info=None,
+        revisit_cache_size=10_000,
+        compression_level=DEFAULT_COMPRESSION_LEVEL
+    ):
+        self._file: RecordWriter | None = None
         self._writer: WARCWriter | None = None
         self._created_names = Counter()
         self._revisit_cache = OrderedDict()
         self._revisit_cache_size = revisit_cache_size
+        # Revisits evicted from the in-memory cache overflow to a temporary
+        # on-disk database (SQLite deletes it when the connection closes).
+        self._revisit_db = sqlite3.connect('', isolation_level=None)
+        self._revisit_db.row_factory = sqlite3.Row
+        self._revisit_db.execute('PRAGMA journal_mode = OFF')
+        self._revisit_db.execute('PRAGMA synchronous = OFF')
+        self._revisit_db.execute(
+            'CREATE TABLE revisits (key TEXT PRIMARY KEY, id TEXT, warc_digest TEXT, uri TEXT, date TEXT)'
+        )
         self.size: int = size
         self.gzip: bool = gzip
+        self.compression_level: int = compression_level
         self.warcinfo: dict = info or {}
         self.path: Path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
         self.base_name: str = name
 
     def close(self):
         self._close_writer()
+        self._revisit_db.close()
 
     def write_records(self, records):
         writer = self._writer
@@ -88,14 +281,24 @@ class WarcSeries:
             writer = self._create_writer(record_time.strftime('--%Y-%m-%dT%H%M%S'))
 
         for record in records:
-            writer.write_record(record)
+            try:
+                writer.write_record(record)
+            except BaseException:
+                # Don't leave part of a record in the WARC.
+                self._file.discard_record()
+                raise
 
         if self._file and self._file.tell() > self.size:
             self._close_writer()
 
     def cache_revisitable_record(self, record, key):
         if len(self._revisit_cache) >= self._revisit_cache_size:
-            self._revisit_cache.popitem()
+            # Move the least recently used entry to the database.
+            old_key, old_revisit = self._revisit_cache.popitem(last=False)
+            self._revisit_db.execute(
+                'INSERT OR REPLACE INTO revisits (key, id, warc_digest, uri, date) VALUES (?, ?, ?, ?, ?)',
+                (old_key, old_revisit['id'], old_revisit['warc_digest'], old_revisit['uri'], old_revisit['date'])
+            )
 
         headers = record.rec_headers
         self._revisit_cache[key] = {
@@ -106,7 +309,16 @@ class WarcSeries:
         }
 
     def get_revisit(self, key) -> dict | None:
-        return self._revisit_cache.get(key)
+        revisit = self._revisit_cache.get(key)
+        if revisit:
+            self._revisit_cache.move_to_end(key)
+            return revisit
+
+        row = self._revisit_db.execute(
+            'SELECT id, warc_digest, uri, date FROM revisits WHERE key = ?',
+            (key,)
+        ).fetchone()
+        return dict(row) if row else None
 
     @property
     def builder(self) -> RecordBuilder:
@@ -117,6 +329,7 @@ class WarcSeries:
 
     def _close_writer(self) -> None:
         self._revisit_cache.clear()
+        self._revisit_db.execute('DELETE FROM revisits')
         self._writer = None
         if self._file:
             self._file.close()
@@ -135,12 +348,12 @@ class WarcSeries:
             file_name += '.gz'
 
         logger.info(f'Creating WARC: "{self.path / file_name}"')
-        self.path.mkdir(parents=True, exist_ok=True)
-        self._file = open(self.path / file_name, 'wb')
-        self._writer = WARCWriter(self._file, gzip=self.gzip, warc_version=WARC_VERSION)
+        file = open(self.path / file_name, 'wb', buffering=WRITE_BUFFER_SIZE)
+        self._file = GzipRecordWriter(file, level=self.compression_level) if self.gzip else RecordWriter(file)
+        self._writer = WARCWriter(self._file, gzip=False, warc_version=WARC_VERSION)
 
         self._writer.write_record(self._writer.create_warcinfo_record(file_name, {
-            'software': f'warcio/{importlib.metadata.version("warcio")}',
+            'software': WARC_SOFTWARE,
             'format': f'WARC file version {WARC_VERSION}',
             **self.warcinfo
         }))